@@ -31,6 +31,9 @@ with a Gaussian process layer.
      https://arxiv.org/abs/2006.07584
 """
 
+from concurrent import futures
+import functools
+import itertools
 import os
 import time
 from absl import app
@@ -70,6 +73,14 @@ flags.DEFINE_string(
 flags.DEFINE_string(
     'bert_config_dir', None, 'Directory to BERT config files. '
     'If None then then default to {bert_dir}/bert_config.json.')
+flags.DEFINE_integer(
+    'attention_chunk_size', 0,
+    'Number of keys per chunk of the self-attention layers. Longer sequences '
+    'are attended to chunk by chunk with a streaming softmax, and the chunks '
+    'are recomputed in the backward pass. This reduces the memory of the '
+    'attention logits from O(seq_length^2) to O(seq_length * '
+    'attention_chunk_size) at the cost of extra compute. If 0, the attention '
+    'is computed over all keys at once.')
 
 # Normalization flags.
 flags.DEFINE_bool(
@@ -142,6 +153,9 @@ flags.DEFINE_list(
     'the moderators (up to 1).')
 flags.DEFINE_string('output_dir', '/tmp/toxic_comments', 'Output directory.')
 flags.DEFINE_integer('train_epochs', 3, 'Number of training epochs.')
+flags.DEFINE_integer(
+    'steps_per_loop', 100,
+    'Number of training steps to run within a single tf.function call.')
 flags.DEFINE_float(
     'warmup_proportion', 0.1,
     'Proportion of training to perform linear learning rate warmup for. '
@@ -151,6 +165,23 @@ flags.DEFINE_float(
     'Threshold used to convert toxicity score into binary labels for computing '
     'Expected Calibration Error (ECE). Default is 0.7 which is the threshold '
     'value recommended by Jigsaw team.')
+flags.DEFINE_bool(
+    'bucket_test_datasets', True,
+    'Whether to batch the test examples by sequence length, so that each '
+    'batch is padded to its bucket boundary rather than to the maximum '
+    'sequence length. Only used on GPU without use_xla, since TPU requires '
+    'static shapes and XLA compiles the evaluation step for every distinct '
+    'batch shape. The last batch of each bucket is partial, so the number of '
+    'evaluation steps is only known once the datasets are exhausted. The test '
+    'NLL is averaged over the examples, which equals the average over the '
+    'equally sized batches without bucketing.')
+flags.DEFINE_bool(
+    'deterministic_train_input', True,
+    'Whether the training input pipeline yields its examples in a '
+    'deterministic order. If False, the parallel parser calls yield their '
+    'examples as soon as they are ready, which avoids stalls on slow calls '
+    'but makes the training input order, and hence the run, depend on thread '
+    'timing rather than only on the seed.')
 flags.DEFINE_integer(
     'num_mc_samples', 1,
     'Number of Monte Carlo forward passes to collect for ensemble prediction. '
@@ -162,7 +193,22 @@ flags.DEFINE_enum('loss_type', 'cross_entropy', ['cross_entropy', 'mse', 'mae'],
 
 # Accelerator flags.
 flags.DEFINE_bool('use_gpu', False, 'Whether to run on GPU or otherwise TPU.')
-flags.DEFINE_bool('use_bfloat16', False, 'Whether to use mixed precision.')
+flags.DEFINE_bool('use_bfloat16', False,
+                  'Whether to use mixed precision bfloat16.')
+flags.DEFINE_bool(
+    'use_mixed_precision', False,
+    'Whether to use the mixed precision best supported by the accelerator, '
+    'i.e., bfloat16 on TPUs and on GPUs with compute capability >= 8.0, and '
+    'float16 with loss scaling on older GPUs. Ignored if use_bfloat16 is set. '
+    'The Gaussian process output layer always computes in float32. Loss '
+    'scaling changes the checkpointed optimizer structure, so resume output '
+    'directories of float16 runs only with the same setting.')
+flags.DEFINE_bool(
+    'use_xla', True,
+    'Whether to compile the model computation of the step functions with XLA '
+    '(i.e., `tf.function(jit_compile=True)`). Metric updates always run '
+    'outside of the compiled region. On GPU, only the evaluation steps are '
+    'compiled, since the training forward pass updates mirrored variables.')
 flags.DEFINE_integer('num_cores', 8, 'Number of TPU cores or number of GPUs.')
 flags.DEFINE_string('tpu', None,
                     'Name of the TPU. Only used if use_gpu is False.')
@@ -171,12 +217,19 @@ flags.DEFINE_string('tpu', None,
 flags.DEFINE_bool('prediction_mode', False, 'Whether to predict only.')
 flags.DEFINE_string('eval_checkpoint_dir', None,
                     'The directory to restore the model weights from for '
-                    'prediction mode.')
+                    'prediction mode. If it contains a SavedModel (e.g., the '
+                    '`model` directory exported at the end of training), the '
+                    'SavedModel is loaded instead of rebuilding the model.')
 
 FLAGS = flags.FLAGS
 
 
 _MAX_SEQ_LENGTH = 512
+# Sequence length boundaries of the test buckets, and the batch size of each
+# bucket as a multiple of the test batch size. Shorter sequences are batched
+# together in larger batches.
+_BUCKET_BOUNDARIES = (64, 128, 256, 384)
+_BUCKET_BATCH_SIZE_MULTIPLIERS = (4, 2, 1, 1, 1)
 _IDENTITY_LABELS = ('male', 'female', 'transgender', 'other_gender',
                     'heterosexual', 'homosexual_gay_or_lesbian', 'bisexual',
                     'other_sexual_orientation', 'christian', 'jewish', 'muslim',
@@ -196,8 +249,107 @@ def _check_checkpoint_dir_for_prediction_mode(flags_dict):
 
 
 def save_prediction(data, path):
-  with (tf.io.gfile.GFile(path + '.npy', 'w')) as test_file:
-    np.save(test_file, np.array(data))
+  """Saves a numpy array of predictions to `path`.npy."""
+  with tf.io.gfile.GFile(path + '.npy', 'wb') as test_file:
+    np.save(test_file, data, allow_pickle=False)
+
+
+def get_mixed_precision_policy_name(use_gpu):
+  """Returns the mixed precision policy best supported by the accelerator."""
+  if not use_gpu:
+    return 'mixed_bfloat16'
+
+  gpus = tf.config.experimental.list_physical_devices('GPU')
+  if not gpus:
+    # float16 needs loss scaling and brings no speedup without a GPU.
+    logging.warning('No GPU is visible, using mixed precision bfloat16.')
+    return 'mixed_bfloat16'
+
+  compute_capabilities = [
+      tf.config.experimental.get_device_details(gpu).get(
+          'compute_capability', (0, 0)) for gpu in gpus
+  ]
+  # bfloat16 tensor cores are only available from Ampere (8.0) onwards.
+  if min(compute_capabilities) >= (8, 0):
+    return 'mixed_bfloat16'
+  return 'mixed_float16'
+
+
+def load_saved_model(saved_model_dir):
+  """Loads a SavedModel exported by `model.save()` for prediction.
+
+  Args:
+    saved_model_dir: Directory of the SavedModel.
+
+  Returns:
+    A function with the calling convention of the Keras model, i.e. it takes
+    the BERT features and a `training` argument, and returns either a tuple of
+    (logits, covmat) or the logits.
+  """
+  loaded_model = tf.saved_model.load(saved_model_dir)
+
+  def model_fn(features, training=False):
+    outputs = loaded_model(features, training=training)
+    if isinstance(outputs, list):
+      outputs = tuple(outputs)
+    return outputs
+
+  return model_fn
+
+
+def compute_ranking_metrics(labels, probs):
+  """Computes the AUROC, AUPR and Brier score of a whole evaluation dataset.
+
+  The toxicity labels are the fraction of raters flagging a comment. Each
+  example counts as a positive with weight `label` and as a negative with
+  weight `1 - label`. The AUROC is the trapezoidal area under the resulting
+  weighted ROC curve, and the AUPR is the weighted average precision, i.e.,
+  the precision at each distinct threshold weighted by the increase in recall.
+  Both are computed exactly over all thresholds. The AUROC is undefined
+  without positive or without negative weight, and the AUPR without positive
+  weight. Undefined metrics are left out of the results with a warning.
+
+  Args:
+    labels: Numpy array of shape [num_examples] of labels in [0, 1].
+    probs: Numpy array of shape [num_examples] of predicted probabilities.
+
+  Returns:
+    A dict with the 'brier' result, and the 'auroc' and 'aupr' results if they
+    are defined.
+  """
+  labels = labels.astype(np.float64)
+  probs = probs.astype(np.float64)
+  results = {'brier': np.mean(np.square(labels - probs))}
+
+  total_positives = np.sum(labels)
+  total_negatives = np.sum(1. - labels)
+  if total_positives <= 0.:
+    logging.warning('No positive labels, skipping the AUROC and AUPR.')
+    return results
+
+  # Accumulate the weighted true and false positives at each distinct
+  # threshold, from the highest to the lowest probability.
+  order = np.argsort(-probs, kind='stable')
+  sorted_probs = probs[order]
+  sorted_labels = labels[order]
+  threshold_indices = np.append(
+      np.flatnonzero(np.diff(sorted_probs)), sorted_probs.size - 1)
+  true_positives = np.cumsum(sorted_labels)[threshold_indices]
+  false_positives = np.cumsum(1. - sorted_labels)[threshold_indices]
+
+  true_positive_rate = np.append(0., true_positives) / total_positives
+  precision = true_positives / (true_positives + false_positives)
+  results['aupr'] = np.sum(np.diff(true_positive_rate) * precision)
+
+  if total_negatives <= 0.:
+    logging.warning('No negative labels, skipping the AUROC.')
+    return results
+  # Trapezoidal rule, where tied probabilities form a diagonal segment.
+  false_positive_rate = np.append(0., false_positives) / total_negatives
+  results['auroc'] = np.sum(
+      np.diff(false_positive_rate) *
+      (true_positive_rate[1:] + true_positive_rate[:-1]) / 2.)
+  return results
 
 
 def resolve_bert_ckpt_and_config_dir(bert_dir, bert_config_dir, bert_ckpt_dir):
@@ -216,17 +368,86 @@ def resolve_bert_ckpt_and_config_dir(bert_dir, bert_config_dir, bert_ckpt_dir):
   return bert_config_dir, bert_ckpt_dir
 
 
-def create_feature_and_label(inputs):
-  """Creates features and labels from model inputs."""
+def bucket_by_sequence_length(dataset, batch_size):
+  """Re-batches a batched dataset by the sequence length of its examples.
+
+  The examples are truncated to the length of their input mask and grouped
+  into buckets of similar length. Each batch is then padded to its bucket
+  boundary instead of to `_MAX_SEQ_LENGTH`.
+
+  Args:
+    dataset: A tf.data.Dataset of batched BERT features.
+    batch_size: The batch size of the buckets of the longest sequences.
+
+  Returns:
+    A tf.data.Dataset whose batches have varying batch sizes and sequence
+    lengths. The last batch of each bucket is partial, so that no example is
+    dropped.
+  """
+
+  def truncate_fn(example):
+    seq_length = tf.reduce_sum(tf.cast(example['input_mask'], tf.int32))
+    for feature_name in ds.BERT_FEATURE_NAMES:
+      example[feature_name] = example[feature_name][:seq_length]
+    return example
+
+  # With pad_to_bucket_boundary=True sequences are padded to the boundary minus
+  # one, hence the offset by one.
+  bucket_boundaries = [
+      boundary + 1 for boundary in _BUCKET_BOUNDARIES + (_MAX_SEQ_LENGTH,)
+  ]
+  # The last bucket only receives sequences longer than _MAX_SEQ_LENGTH, which
+  # do not exist.
+  bucket_batch_sizes = [
+      batch_size * multiplier
+      for multiplier in _BUCKET_BATCH_SIZE_MULTIPLIERS + (1,)
+  ]
+  dataset = dataset.unbatch().map(
+      truncate_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+  dataset = dataset.apply(
+      tf.data.experimental.bucket_by_sequence_length(
+          element_length_func=lambda x: tf.shape(x['input_ids'])[0],
+          bucket_boundaries=bucket_boundaries,
+          bucket_batch_sizes=bucket_batch_sizes,
+          pad_to_bucket_boundary=True,
+          drop_remainder=False))
+  return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+
+def get_eval_steps(num_steps):
+  """Returns the evaluation steps, unbounded if `num_steps` is None.
+
+  Datasets bucketed by sequence length have an unknown number of batches, and
+  are instead evaluated until they raise `tf.errors.OutOfRangeError`.
+
+  Args:
+    num_steps: Number of evaluation steps, or None if it is unknown.
+
+  Returns:
+    An iterable of the step indices.
+  """
+  return itertools.count() if num_steps is None else range(num_steps)
+
+
+def create_feature_and_label(inputs, identity_label_names=()):
+  """Creates features and labels from model inputs.
+
+  Args:
+    inputs: A dictionary of batched model inputs.
+    identity_label_names: Names of the identity labels to extract from
+      `inputs`. They are resolved per dataset before tracing, so that the traced
+      function only contains the labels that the dataset actually has.
+
+  Returns:
+    A tuple of the BERT features, the labels and a dictionary of the identity
+    labels.
+  """
   input_ids = inputs['input_ids']
   input_mask = inputs['input_mask']
   segment_ids = inputs['segment_ids']
 
   labels = inputs['labels']
-  additional_labels = {}
-  for additional_label in _IDENTITY_LABELS:
-    if additional_label in inputs:
-      additional_labels[additional_label] = inputs[additional_label]
+  additional_labels = {name: inputs[name] for name in identity_label_names}
 
   return [input_ids, input_mask, segment_ids], labels, additional_labels
 
@@ -253,23 +474,23 @@ def main(argv):
   data_buffer_size = batch_size * 10
 
   train_dataset_builder = ds.WikipediaToxicityDataset(
-      batch_size=FLAGS.per_core_batch_size,
-      eval_batch_size=FLAGS.per_core_batch_size,
+      batch_size=batch_size,
+      eval_batch_size=test_batch_size,
       data_dir=FLAGS.in_dataset_dir,
       shuffle_buffer_size=data_buffer_size)
   ind_dataset_builder = ds.WikipediaToxicityDataset(
-      batch_size=FLAGS.per_core_batch_size,
-      eval_batch_size=FLAGS.per_core_batch_size,
+      batch_size=batch_size,
+      eval_batch_size=test_batch_size,
       data_dir=FLAGS.in_dataset_dir,
       shuffle_buffer_size=data_buffer_size)
   ood_dataset_builder = ds.CivilCommentsDataset(
-      batch_size=FLAGS.per_core_batch_size,
-      eval_batch_size=FLAGS.per_core_batch_size,
+      batch_size=batch_size,
+      eval_batch_size=test_batch_size,
       data_dir=FLAGS.ood_dataset_dir,
       shuffle_buffer_size=data_buffer_size)
   ood_identity_dataset_builder = ds.CivilCommentsIdentitiesDataset(
-      batch_size=FLAGS.per_core_batch_size,
-      eval_batch_size=FLAGS.per_core_batch_size,
+      batch_size=batch_size,
+      eval_batch_size=test_batch_size,
       data_dir=FLAGS.identity_dataset_dir,
       shuffle_buffer_size=data_buffer_size)
 
@@ -280,22 +501,54 @@ def main(argv):
   }
 
   train_dataset = train_dataset_builder.build(split=base.Split.TRAIN)
+  if not FLAGS.deterministic_train_input:
+    # The test pipelines stay deterministic, so that the evaluated batches and
+    # the order of the saved predictions are stable.
+    input_options = tf.data.Options()
+    input_options.experimental_deterministic = False
+    train_dataset = train_dataset.with_options(input_options)
+  train_dataset = strategy.experimental_distribute_dataset(train_dataset)
 
   ds_info = train_dataset_builder.info
   num_classes = ds_info['num_classes']  # Positive and negative classes.
 
   steps_per_epoch = ds_info['num_train_examples'] // batch_size
 
+  # Each distinct (batch size, sequence length) of the buckets would trigger
+  # a new XLA compilation of the evaluation step.
+  use_bucketing = (
+      FLAGS.bucket_test_datasets and FLAGS.use_gpu and not FLAGS.use_xla)
+  if FLAGS.bucket_test_datasets and FLAGS.use_gpu and FLAGS.use_xla:
+    logging.info('Not bucketing the test datasets, since use_xla is set.')
   test_datasets = {}
   steps_per_eval = {}
   for dataset_name, dataset_builder in dataset_builders.items():
-    test_datasets[dataset_name] = dataset_builder.build(split=base.Split.TEST)
-    steps_per_eval[dataset_name] = (
-        dataset_builder.info['num_test_examples'] // test_batch_size)
+    test_dataset = dataset_builder.build(split=base.Split.TEST)
+    if use_bucketing:
+      test_dataset = bucket_by_sequence_length(test_dataset, test_batch_size)
+      steps_per_eval[dataset_name] = None
+    else:
+      steps_per_eval[dataset_name] = (
+          dataset_builder.info['num_test_examples'] // test_batch_size)
+    test_datasets[dataset_name] = strategy.experimental_distribute_dataset(
+        test_dataset)
+
+  identity_label_names = {
+      dataset_name: tuple(label_name for label_name in _IDENTITY_LABELS
+                          if label_name in dataset_builder.additional_labels)
+      for dataset_name, dataset_builder in dataset_builders.items()
+  }
 
-  if FLAGS.use_bfloat16:
-    policy = tf.keras.mixed_precision.experimental.Policy('mixed_bfloat16')
+  use_loss_scaling = False
+  if FLAGS.use_bfloat16 or FLAGS.use_mixed_precision:
+    if FLAGS.use_bfloat16:
+      policy_name = 'mixed_bfloat16'
+    else:
+      policy_name = get_mixed_precision_policy_name(FLAGS.use_gpu)
+    logging.info('Using mixed precision policy %s', policy_name)
+    policy = tf.keras.mixed_precision.experimental.Policy(policy_name)
     tf.keras.mixed_precision.experimental.set_policy(policy)
+    use_loss_scaling = policy_name == 'mixed_float16'
 
   summary_writer = tf.summary.create_file_writer(
       os.path.join(FLAGS.output_dir, 'summaries'))
@@ -307,42 +560,73 @@ def main(argv):
     logging.info('use_spec_norm_ffn=%s', FLAGS.use_spec_norm_ffn)
     logging.info('use_layer_norm_att=%s', FLAGS.use_layer_norm_att)
     logging.info('use_layer_norm_ffn=%s', FLAGS.use_layer_norm_ffn)
-
-    bert_config_dir, bert_ckpt_dir = resolve_bert_ckpt_and_config_dir(
-        FLAGS.bert_dir, FLAGS.bert_config_dir, FLAGS.bert_ckpt_dir)
-    bert_config = bert_utils.create_config(bert_config_dir)
-
-    gp_layer_kwargs = dict(
-        num_inducing=FLAGS.gp_hidden_dim,
-        gp_kernel_scale=FLAGS.gp_scale,
-        gp_output_bias=FLAGS.gp_bias,
-        normalize_input=FLAGS.gp_input_normalization,
-        gp_cov_momentum=FLAGS.gp_cov_discount_factor,
-        gp_cov_ridge_penalty=FLAGS.gp_cov_ridge_penalty)
-    spec_norm_kwargs = dict(
-        iteration=FLAGS.spec_norm_iteration,
-        norm_multiplier=FLAGS.spec_norm_bound)
-
-    model, bert_encoder = ub.models.SngpBertBuilder(
-        num_classes=num_classes,
-        bert_config=bert_config,
-        gp_layer_kwargs=gp_layer_kwargs,
-        spec_norm_kwargs=spec_norm_kwargs,
-        use_gp_layer=FLAGS.use_gp_layer,
-        use_spec_norm_att=FLAGS.use_spec_norm_att,
-        use_spec_norm_ffn=FLAGS.use_spec_norm_ffn,
-        use_layer_norm_att=FLAGS.use_layer_norm_att,
-        use_layer_norm_ffn=FLAGS.use_layer_norm_ffn,
-        use_spec_norm_plr=FLAGS.use_spec_norm_plr)
-    optimizer = bert_utils.create_optimizer(
-        FLAGS.base_learning_rate,
-        steps_per_epoch=steps_per_epoch,
-        epochs=FLAGS.train_epochs,
-        warmup_proportion=FLAGS.warmup_proportion)
-
-    logging.info('Model input shape: %s', model.input_shape)
-    logging.info('Model output shape: %s', model.output_shape)
-    logging.info('Model number of weights: %s', model.count_params())
+    logging.info('attention_chunk_size=%s', FLAGS.attention_chunk_size)
+
+    # In prediction mode, load the exported SavedModel if there is one rather
+    # than rebuilding the BERT model and overwriting its weights.
+    use_saved_model = FLAGS.prediction_mode and tf.io.gfile.exists(
+        os.path.join(FLAGS.eval_checkpoint_dir, 'saved_model.pb'))
+    if use_saved_model:
+      model = load_saved_model(FLAGS.eval_checkpoint_dir)
+      logging.info('Loaded SavedModel %s', FLAGS.eval_checkpoint_dir)
+    else:
+      bert_config_dir, bert_ckpt_dir = resolve_bert_ckpt_and_config_dir(
+          FLAGS.bert_dir, FLAGS.bert_config_dir, FLAGS.bert_ckpt_dir)
+      bert_config = bert_utils.create_config(bert_config_dir)
+
+      gp_layer_kwargs = dict(
+          num_inducing=FLAGS.gp_hidden_dim,
+          gp_kernel_scale=FLAGS.gp_scale,
+          gp_output_bias=FLAGS.gp_bias,
+          normalize_input=FLAGS.gp_input_normalization,
+          gp_cov_momentum=FLAGS.gp_cov_discount_factor,
+          gp_cov_ridge_penalty=FLAGS.gp_cov_ridge_penalty,
+          # Keep the GP layer, including the moving-average precision matrix
+          # and the posterior covariance, in float32 for numerical stability.
+          dtype=tf.float32)
+      spec_norm_kwargs = dict(
+          iteration=FLAGS.spec_norm_iteration,
+          norm_multiplier=FLAGS.spec_norm_bound)
+
+      model, bert_encoder = ub.models.SngpBertBuilder(
+          num_classes=num_classes,
+          bert_config=bert_config,
+          gp_layer_kwargs=gp_layer_kwargs,
+          spec_norm_kwargs=spec_norm_kwargs,
+          use_gp_layer=FLAGS.use_gp_layer,
+          use_spec_norm_att=FLAGS.use_spec_norm_att,
+          use_spec_norm_ffn=FLAGS.use_spec_norm_ffn,
+          use_layer_norm_att=FLAGS.use_layer_norm_att,
+          use_layer_norm_ffn=FLAGS.use_layer_norm_ffn,
+          use_spec_norm_plr=FLAGS.use_spec_norm_plr,
+          attention_chunk_size=FLAGS.attention_chunk_size or None)
+      optimizer = bert_utils.create_optimizer(
+          FLAGS.base_learning_rate,
+          steps_per_epoch=steps_per_epoch,
+          epochs=FLAGS.train_epochs,
+          warmup_proportion=FLAGS.warmup_proportion)
+      if use_loss_scaling:
+        # The wrapper tracks the BERT optimizer as a dependency, so checkpoints
+        # written without loss scaling do not restore its iterations.
+        optimizer = tf.keras.mixed_precision.experimental.LossScaleOptimizer(
+            optimizer, loss_scale='dynamic')
+
+    # Posterior covariance used by models without a Gaussian process output
+    # layer. It is created once on the replicas rather than at every step, and
+    # is large enough for the largest test batch tiled over all the Monte Carlo
+    # samples.
+    max_batch_size = FLAGS.per_core_batch_size * FLAGS.num_mc_samples
+    if use_bucketing:
+      max_batch_size *= max(_BUCKET_BATCH_SIZE_MULTIPLIERS)
+    identity_covmat = tf.Variable(
+        tf.eye(max_batch_size),
+        trainable=False,
+        name='identity_covmat')
+
+    if not use_saved_model:
+      logging.info('Model input shape: %s', model.input_shape)
+      logging.info('Model output shape: %s', model.output_shape)
+      logging.info('Model number of weights: %s', model.count_params())
 
     metrics = {
         'train/negative_log_likelihood': tf.keras.metrics.Mean(),
@@ -351,54 +635,53 @@ def main(argv):
         'train/ece': um.ExpectedCalibrationError(num_bins=FLAGS.num_bins),
     }
 
-    checkpoint = tf.train.Checkpoint(model=model, optimizer=optimizer)
-    if FLAGS.prediction_mode:
-      latest_checkpoint = tf.train.latest_checkpoint(FLAGS.eval_checkpoint_dir)
-    else:
-      latest_checkpoint = tf.train.latest_checkpoint(FLAGS.output_dir)
     initial_epoch = 0
-    if latest_checkpoint:
-      # checkpoint.restore must be within a strategy.scope() so that optimizer
-      # slot variables are mirrored.
-      checkpoint.restore(latest_checkpoint)
-      logging.info('Loaded checkpoint %s', latest_checkpoint)
-      initial_epoch = optimizer.iterations.numpy() // steps_per_epoch
-    else:
-      # load BERT from initial checkpoint
-      bert_encoder, _, _ = bert_utils.load_bert_weight_from_ckpt(
-          bert_model=bert_encoder,
-          bert_ckpt_dir=bert_ckpt_dir,
-          repl_patterns=ub.models.bert_sngp.CHECKPOINT_REPL_PATTERNS)
-      logging.info('Loaded BERT checkpoint %s', bert_ckpt_dir)
+    if not use_saved_model:
+      checkpoint = tf.train.Checkpoint(model=model, optimizer=optimizer)
+      if FLAGS.prediction_mode:
+        checkpoint_dir = FLAGS.eval_checkpoint_dir
+      else:
+        checkpoint_dir = FLAGS.output_dir
+      # The manager reads the checkpoint state of the directory once, and keeps
+      # track of the checkpoints saved during training afterwards.
+      checkpoint_manager = tf.train.CheckpointManager(
+          checkpoint,
+          checkpoint_dir,
+          max_to_keep=None,
+          checkpoint_name='checkpoint')
+      latest_checkpoint = checkpoint_manager.latest_checkpoint
+      if latest_checkpoint:
+        # checkpoint.restore must be within a strategy.scope() so that optimizer
+        # slot variables are mirrored.
+        status = checkpoint.restore(latest_checkpoint)
+        if FLAGS.prediction_mode:
+          # Prediction does not need the optimizer slot variables.
+          status.expect_partial()
+        logging.info('Loaded checkpoint %s', latest_checkpoint)
+        initial_epoch = optimizer.iterations.numpy() // steps_per_epoch
+      else:
+        # load BERT from initial checkpoint
+        bert_encoder, _, _ = bert_utils.load_bert_weight_from_ckpt(
+            bert_model=bert_encoder,
+            bert_ckpt_dir=bert_ckpt_dir,
+            repl_patterns=ub.models.bert_sngp.CHECKPOINT_REPL_PATTERNS)
+        logging.info('Loaded BERT checkpoint %s', bert_ckpt_dir)
 
     # Finally, define test metrics outside the accelerator scope for CPU eval.
+    # The AUROC, AUPR and Brier score are computed on host with
+    # `compute_ranking_metrics` over the whole evaluation dataset.
     metrics.update({
         'test/nll': tf.keras.metrics.Mean(),
-        'test/auroc': tf.keras.metrics.AUC(curve='ROC'),
-        'test/aupr': tf.keras.metrics.AUC(curve='PR'),
-        'test/brier': tf.keras.metrics.MeanSquaredError(),
         'test/ece': um.ExpectedCalibrationError(num_bins=FLAGS.num_bins),
         'test/eval_time': tf.keras.metrics.Mean(),
         'test/stddev': tf.keras.metrics.Mean(),
         'test/acc': tf.keras.metrics.Accuracy(),
     })
-    for fraction in FLAGS.fractions:
-      metrics.update({
-          'test_collab_acc/collab_acc_{}'.format(fraction):
-              um.OracleCollaborativeAccuracy(
-                  fraction=float(fraction), num_bins=FLAGS.num_bins)
-      })
     for dataset_name, test_dataset in test_datasets.items():
       if dataset_name != 'ind':
         metrics.update({
             'test/nll_{}'.format(dataset_name):
                 tf.keras.metrics.Mean(),
-            'test/auroc_{}'.format(dataset_name):
-                tf.keras.metrics.AUC(curve='ROC'),
-            'test/aupr_{}'.format(dataset_name):
-                tf.keras.metrics.AUC(curve='PR'),
-            'test/brier_{}'.format(dataset_name):
-                tf.keras.metrics.MeanSquaredError(),
             'test/ece_{}'.format(dataset_name):
                 um.ExpectedCalibrationError(num_bins=FLAGS.num_bins),
             'test/eval_time_{}'.format(dataset_name):
@@ -408,57 +691,83 @@ def main(argv):
             'test/acc_{}'.format(dataset_name):
                 tf.keras.metrics.Accuracy()
         })
-        for fraction in FLAGS.fractions:
-          metrics.update({
-              'test_collab_acc/collab_acc_{}_{}'.format(fraction, dataset_name):
-                  um.OracleCollaborativeAccuracy(
-                      fraction=float(fraction), num_bins=FLAGS.num_bins)
-          })
+
+  # The loss is selected once here, so that the traced training step only
+  # contains the ops of the selected loss. The cross entropy takes the logits,
+  # while the other losses take the probabilities.
+  loss_fns = {
+      'cross_entropy': tf.nn.sigmoid_cross_entropy_with_logits,
+      'mse': tf.math.squared_difference,
+      'mae': lambda labels, probs: tf.abs(labels - probs),
+  }
+  loss_fn = loss_fns[FLAGS.loss_type]
+  loss_from_logits = FLAGS.loss_type == 'cross_entropy'
+  logging.info('Using %s loss', FLAGS.loss_type)
+
+  # The training forward pass assigns to the GP precision matrix and to the
+  # spectral normalization power iterates. Under MirroredStrategy these are
+  # mirrored variables synchronized across replicas, which XLA does not
+  # support within a compiled cluster. TPU computations are compiled anyway.
+  train_jit_compile = FLAGS.use_xla and not FLAGS.use_gpu
+
+  @tf.function(jit_compile=train_jit_compile)
+  def train_compute_fn(features, labels):
+    """Computes the loss and gradients of a single training batch."""
+    with tf.GradientTape() as tape:
+      logits = model(features, training=True)
+
+      if isinstance(logits, tuple):
+        # If model returns a tuple of (logits, covmat), extract logits
+        logits, _ = logits
+      # The dense output layer computes in the mixed precision policy. The cast
+      # is a no-op for the float32 outputs of the GP layer.
+      logits = tf.cast(logits, tf.float32)
+
+      # The probabilities are also used by the training metrics.
+      probs = tf.nn.sigmoid(logits)
+      loss_inputs = logits if loss_from_logits else probs
+      per_example_loss = loss_fn(labels, tf.squeeze(loss_inputs, axis=1))
+
+      # Models without regularization losses, e.g. with the dense output layer,
+      # would otherwise sum to a Python int. Regularization losses of mixed
+      # precision layers are cast to float32 as well.
+      if model.losses:
+        l2_loss = tf.add_n(
+            [tf.cast(reg_loss, tf.float32) for reg_loss in model.losses])
+      else:
+        l2_loss = tf.constant(0.)
+      # Average over the global batch and scale the regularization loss given
+      # the strategy will reduce sum all gradients over the replicas.
+      scaled_loss = (
+          tf.nn.compute_average_loss(
+              per_example_loss, global_batch_size=batch_size) +
+          tf.nn.scale_regularization_loss(l2_loss))
+      if use_loss_scaling:
+        scaled_loss = optimizer.get_scaled_loss(scaled_loss)
+
+    grads = tape.gradient(scaled_loss, model.trainable_variables)
+    if use_loss_scaling:
+      grads = optimizer.get_unscaled_gradients(grads)
+
+    # The per-replica losses are reported in the training metrics.
+    negative_log_likelihood = tf.reduce_mean(per_example_loss)
+    loss = negative_log_likelihood + l2_loss
+    return grads, probs, loss, negative_log_likelihood
 
   @tf.function
-  def train_step(iterator):
-    """Training StepFn."""
+  def train_step(iterator, num_steps):
+    """Training StepFn running `num_steps` steps on the accelerator."""
 
     def step_fn(inputs):
       """Per-Replica StepFn."""
       features, labels, _ = create_feature_and_label(inputs)
 
-      with tf.GradientTape() as tape:
-        logits = model(features, training=True)
-
-        if isinstance(logits, tuple):
-          # If model returns a tuple of (logits, covmat), extract logits
-          logits, _ = logits
-        if FLAGS.use_bfloat16:
-          logits = tf.cast(logits, tf.float32)
-
-        loss_logits = tf.squeeze(logits, axis=1)
-        if FLAGS.loss_type == 'cross_entropy':
-          logging.info('Using cross entropy loss')
-          negative_log_likelihood = tf.nn.sigmoid_cross_entropy_with_logits(
-              labels, loss_logits)
-        elif FLAGS.loss_type == 'mse':
-          logging.info('Using mean squared error loss')
-          loss_probs = tf.nn.sigmoid(loss_logits)
-          negative_log_likelihood = tf.keras.losses.mean_squared_error(
-              labels, loss_probs)
-        elif FLAGS.loss_type == 'mae':
-          logging.info('Using mean absolute error loss')
-          loss_probs = tf.nn.sigmoid(loss_logits)
-          negative_log_likelihood = tf.keras.losses.mean_absolute_error(
-              labels, loss_probs)
-
-        negative_log_likelihood = tf.reduce_mean(negative_log_likelihood)
-
-        l2_loss = sum(model.losses)
-        loss = negative_log_likelihood + l2_loss
-        # Scale the loss given the TPUStrategy will reduce sum all gradients.
-        scaled_loss = loss / strategy.num_replicas_in_sync
-
-      grads = tape.gradient(scaled_loss, model.trainable_variables)
+      # Gradients are aggregated across replicas by apply_gradients, which
+      # therefore stays outside of the XLA-compiled computation.
+      grads, probs, loss, negative_log_likelihood = train_compute_fn(
+          features, labels)
       optimizer.apply_gradients(zip(grads, model.trainable_variables))
 
-      probs = tf.nn.sigmoid(logits)
       # Cast labels to discrete for ECE computation.
       ece_labels = tf.cast(labels > FLAGS.ece_label_threshold, tf.float32)
       ece_probs = tf.concat([1. - probs, probs], axis=1)
@@ -470,214 +779,237 @@ def main(argv):
       metrics['train/negative_log_likelihood'].update_state(
           negative_log_likelihood)
 
-    strategy.run(step_fn, args=(next(iterator),))
+    for _ in tf.range(num_steps):
+      strategy.run(step_fn, args=(next(iterator),))
+
+  def compute_mean_field_logits(features):
+    """Computes the mean-field logits and the posterior covariance."""
+    logits = model(features, training=False)
+    if isinstance(logits, tuple):
+      # If model returns a tuple of (logits, covmat), extract both.
+      logits, covmat = logits
+      covmat = tf.cast(covmat, tf.float32)
+    else:
+      batch_size = tf.shape(logits)[0]
+      covmat = identity_covmat[:batch_size, :batch_size]
+    logits = tf.cast(logits, tf.float32)
+
+    logits = ed.layers.utils.mean_field_logits(
+        logits, covmat, mean_field_factor=FLAGS.gp_mean_field_factor)
+    return logits, covmat
+
+  @tf.function(jit_compile=FLAGS.use_xla)
+  def test_compute_fn(features, labels):
+    """Computes the predictive distribution of a single evaluation batch.
+
+    The negative log-likelihood is returned per example, so that the test
+    metrics weigh the examples of bucketed batches of different sizes equally.
+    For batches of equal size, the resulting test NLL is the same as the mean
+    of the per-batch NLLs.
+    """
+    if FLAGS.num_mc_samples == 1:
+      # Skip the ensemble reduction, which is an identity for a single sample.
+      logits, covmat = compute_mean_field_logits(features)
+      stddev = tf.sqrt(tf.linalg.diag_part(covmat))
+      probs = tf.nn.sigmoid(logits)
+      negative_log_likelihood = tf.nn.sigmoid_cross_entropy_with_logits(
+          labels, tf.squeeze(logits, axis=1))
+      return probs, stddev, negative_log_likelihood
+
+    # Compute ensemble prediction over Monte Carlo forward-pass samples. The
+    # batch is tiled so that a single forward pass computes all the samples.
+    num_samples = FLAGS.num_mc_samples
+    tiled_features = tf.nest.map_structure(
+        lambda t: tf.tile(t, [num_samples] + [1] * (t.shape.rank - 1)),
+        features)
+    logits, covmat = compute_mean_field_logits(tiled_features)
+
+    # Logits dimension is (num_samples, batch_size, num_classes).
+    logits_list = tf.reshape(logits, [num_samples, -1, logits.shape[-1]])
+    stddev_list = tf.reshape(
+        tf.sqrt(tf.linalg.diag_part(covmat)), [num_samples, -1])
+
+    stddev = tf.reduce_mean(stddev_list, axis=0)
+    probs_list = tf.nn.sigmoid(logits_list)
+    probs = tf.reduce_mean(probs_list, axis=0)
+
+    ce = tf.nn.sigmoid_cross_entropy_with_logits(
+        labels=tf.broadcast_to(
+            labels, [FLAGS.num_mc_samples, tf.shape(labels)[0]]),
+        logits=tf.squeeze(logits_list, axis=-1))
+    negative_log_likelihood = -tf.reduce_logsumexp(
+        -ce, axis=0) + tf.math.log(float(FLAGS.num_mc_samples))
+    return probs, stddev, negative_log_likelihood
 
-  @tf.function
   def test_step(iterator, dataset_name):
     """Evaluation StepFn."""
+    metric_suffix = '' if dataset_name == 'ind' else '_{}'.format(dataset_name)
 
     def step_fn(inputs):
       """Per-Replica StepFn."""
       features, labels, _ = create_feature_and_label(inputs)
+      probs, stddev, negative_log_likelihood = test_compute_fn(
+          features, labels)
 
-      # Compute ensemble prediction over Monte Carlo forward-pass samples.
-      logits_list = []
-      stddev_list = []
-      for _ in range(FLAGS.num_mc_samples):
-        logits = model(features, training=False)
-
-        if isinstance(logits, tuple):
-          # If model returns a tuple of (logits, covmat), extract both.
-          logits, covmat = logits
-        else:
-          covmat = tf.eye(test_batch_size)
-
-        if FLAGS.use_bfloat16:
-          logits = tf.cast(logits, tf.float32)
-          covmat = tf.cast(covmat, tf.float32)
-
-        logits = ed.layers.utils.mean_field_logits(
-            logits, covmat, mean_field_factor=FLAGS.gp_mean_field_factor)
-        stddev = tf.sqrt(tf.linalg.diag_part(covmat))
-
-        logits_list.append(logits)
-        stddev_list.append(stddev)
-
-      # Logits dimension is (num_samples, batch_size, num_classes).
-      logits_list = tf.stack(logits_list, axis=0)
-      stddev_list = tf.stack(stddev_list, axis=0)
-
-      stddev = tf.reduce_mean(stddev_list, axis=0)
-      probs_list = tf.nn.sigmoid(logits_list)
-      probs = tf.reduce_mean(probs_list, axis=0)
       # Cast labels to discrete for ECE computation.
       ece_labels = tf.cast(labels > FLAGS.ece_label_threshold, tf.float32)
       ece_probs = tf.concat([1. - probs, probs], axis=1)
       pred_labels = tf.math.argmax(ece_probs, axis=-1)
-      auc_probs = tf.squeeze(probs, axis=1)
-
-      ce = tf.nn.sigmoid_cross_entropy_with_logits(
-          labels=tf.broadcast_to(
-              labels, [FLAGS.num_mc_samples, labels.shape[0]]),
-          logits=tf.squeeze(logits_list, axis=-1)
-      )
-      negative_log_likelihood = -tf.reduce_logsumexp(
-          -ce, axis=0) + tf.math.log(float(FLAGS.num_mc_samples))
-      negative_log_likelihood = tf.reduce_mean(negative_log_likelihood)
-
-      if dataset_name == 'ind':
-        metrics['test/nll'].update_state(
-            negative_log_likelihood)
-        metrics['test/auroc'].update_state(labels, auc_probs)
-        metrics['test/aupr'].update_state(labels, auc_probs)
-        metrics['test/brier'].update_state(labels, auc_probs)
-        metrics['test/ece'].update_state(ece_labels, ece_probs)
-        metrics['test/stddev'].update_state(stddev)
-        metrics['test/acc'].update_state(ece_labels, pred_labels)
-        for fraction in FLAGS.fractions:
-          metrics['test_collab_acc/collab_acc_{}'.format(
-              fraction)].update_state(ece_labels, ece_probs)
-      else:
-        metrics['test/nll_{}'.format(dataset_name)].update_state(
-            negative_log_likelihood)
-        metrics['test/auroc_{}'.format(dataset_name)].update_state(
-            labels, auc_probs)
-        metrics['test/aupr_{}'.format(dataset_name)].update_state(
-            labels, auc_probs)
-        metrics['test/brier_{}'.format(dataset_name)].update_state(
-            labels, auc_probs)
-        metrics['test/ece_{}'.format(dataset_name)].update_state(
-            ece_labels, ece_probs)
-        metrics['test/stddev_{}'.format(dataset_name)].update_state(stddev)
-        metrics['test/acc_{}'.format(dataset_name)].update_state(
-            ece_labels, pred_labels
-        )
-        for fraction in FLAGS.fractions:
-          metrics['test_collab_acc/collab_acc_{}_{}'.format(
-              fraction, dataset_name)].update_state(ece_labels, ece_probs)
-
-    strategy.run(step_fn, args=(next(iterator),))
+
+      metrics['test/nll' + metric_suffix].update_state(negative_log_likelihood)
+      metrics['test/ece' + metric_suffix].update_state(ece_labels, ece_probs)
+      metrics['test/stddev' + metric_suffix].update_state(stddev)
+      metrics['test/acc' + metric_suffix].update_state(ece_labels, pred_labels)
+      return labels, ece_labels, ece_probs
+
+    # The labels and probabilities are returned to compute the collaborative
+    # accuracy and the ranking metrics once per epoch rather than at every step.
+    outputs = strategy.run(step_fn, args=(next(iterator),))
+    return tf.nest.map_structure(
+        lambda values: strategy.gather(values, axis=0), outputs)
+
+  # Bind each dataset to its own step function, whose trace only updates the
+  # metrics of that dataset.
+  test_steps = {
+      dataset_name: tf.function(
+          functools.partial(test_step, dataset_name=dataset_name))
+      for dataset_name in test_datasets
+  }
+
+  @tf.function(jit_compile=FLAGS.use_xla)
+  def final_eval_compute_fn(bert_features):
+    """Computes the mean-field logits of a single prediction batch."""
+    logits, _ = compute_mean_field_logits(bert_features)
+    return logits
+
+  # Resolved when final_eval_step is traced, so that the single replica graph
+  # does not gather the per-replica outputs.
+  is_distributed = strategy.num_replicas_in_sync > 1
 
   @tf.function
-  def final_eval_step(iterator):
+  def final_eval_step(iterator, dataset_name):
     """Final Evaluation StepFn to save prediction to directory."""
+    label_names = identity_label_names[dataset_name]
 
     def step_fn(inputs):
       bert_features, labels, additional_labels = create_feature_and_label(
-          inputs)
-      logits = model(bert_features, training=False)
-      if isinstance(logits, tuple):
-        # If model returns a tuple of (logits, covmat), extract both.
-        logits, covmat = logits
-      else:
-        covmat = tf.eye(test_batch_size)
-
-      if FLAGS.use_bfloat16:
-        logits = tf.cast(logits, tf.float32)
-        covmat = tf.cast(covmat, tf.float32)
-
-      logits = ed.layers.utils.mean_field_logits(
-          logits, covmat, mean_field_factor=FLAGS.gp_mean_field_factor)
+          inputs, label_names)
+      logits = final_eval_compute_fn(bert_features)
+      # Pad the texts back to the maximum sequence length so that batches of
+      # different buckets can be concatenated.
       features = inputs['input_ids']
+      features = tf.pad(
+          features, [[0, 0], [0, _MAX_SEQ_LENGTH - tf.shape(features)[1]]])
       return features, logits, labels, additional_labels
 
     (per_replica_texts, per_replica_logits, per_replica_labels,
      per_replica_additional_labels) = (
          strategy.run(step_fn, args=(next(iterator),)))
 
-    if strategy.num_replicas_in_sync > 1:
-      texts_list = tf.concat(per_replica_texts.values, axis=0)
-      logits_list = tf.concat(per_replica_logits.values, axis=0)
-      labels_list = tf.concat(per_replica_labels.values, axis=0)
-      additional_labels_dict = {}
-      for additional_label in _IDENTITY_LABELS:
-        if additional_label in per_replica_additional_labels:
-          additional_labels_dict[additional_label] = tf.concat(
-              per_replica_additional_labels[additional_label], axis=0)
-    else:
-      texts_list = per_replica_texts
-      logits_list = per_replica_logits
-      labels_list = per_replica_labels
-      additional_labels_dict = {}
-      for additional_label in _IDENTITY_LABELS:
-        if additional_label in per_replica_additional_labels:
-          additional_labels_dict[
-              additional_label] = per_replica_additional_labels[
-                  additional_label]
+    if not is_distributed:
+      # A single replica returns plain tensors, which need no gathering.
+      return (per_replica_texts, per_replica_logits, per_replica_labels,
+              per_replica_additional_labels)
 
+    texts_list, logits_list, labels_list, additional_labels_dict = (
+        tf.nest.map_structure(
+            lambda values: strategy.gather(values, axis=0),
+            (per_replica_texts, per_replica_logits, per_replica_labels,
+             per_replica_additional_labels)))
     return texts_list, logits_list, labels_list, additional_labels_dict
 
   if FLAGS.prediction_mode:
-    # Prediction and exit.
-    for dataset_name, test_dataset in test_datasets.items():
-      test_iterator = iter(test_dataset)  # pytype: disable=wrong-arg-types
-      message = 'Final eval on dataset {}'.format(dataset_name)
-      logging.info(message)
-
-      texts_all = []
-      logits_all = []
-      labels_all = []
-      additional_labels_all_dict = {}
-      if 'identity' in dataset_name:
-        for identity_label_name in _IDENTITY_LABELS:
-          additional_labels_all_dict[identity_label_name] = []
-
-      for step in range(steps_per_eval[dataset_name]):
-        if step % 20 == 0:
-          message = 'Starting to run eval step {}/{} of dataset: {}'.format(
-              step, steps_per_eval[dataset_name], dataset_name)
-          logging.info(message)
-
-        try:
-          (text_step, logits_step, labels_step,
-           additional_labels_dict_step) = final_eval_step(test_iterator)
-        except tf.errors.OutOfRangeError:
-          continue
-
-        texts_all.append(text_step)
-        logits_all.append(logits_step)
-        labels_all.append(labels_step)
+    # Prediction and exit. Predictions are written by background threads, so
+    # that saving one dataset overlaps with predicting on the next one. The
+    # executor is shut down even if prediction fails.
+    with futures.ThreadPoolExecutor(max_workers=4) as save_executor:
+      save_futures = []
+      for dataset_name, test_dataset in test_datasets.items():
+        test_iterator = iter(test_dataset)  # pytype: disable=wrong-arg-types
+        message = 'Final eval on dataset {}'.format(dataset_name)
+        logging.info(message)
+
+        # Accumulate the per-step outputs in TensorArrays, which are
+        # concatenated once at the end. They grow with the number of steps
+        # actually written, since the dataset may run out before
+        # steps_per_eval, or have an unknown number of steps.
+        def make_tensor_array(dtype):
+          return tf.TensorArray(
+              dtype, size=0, dynamic_size=True, infer_shape=False)
+
+        texts_all = make_tensor_array(tf.int32)
+        logits_all = make_tensor_array(tf.float32)
+        labels_all = make_tensor_array(tf.float32)
+        additional_labels_all_dict = {}
+        for identity_label_name in identity_label_names[dataset_name]:
+          additional_labels_all_dict[identity_label_name] = make_tensor_array(
+              tf.float32)
+
+        num_steps = 0
+        for step in get_eval_steps(steps_per_eval[dataset_name]):
+          if step % 20 == 0:
+            message = 'Starting to run eval step {}/{} of dataset: {}'.format(
+                step, steps_per_eval[dataset_name] or '?', dataset_name)
+            logging.info(message)
+
+          try:
+            (text_step, logits_step, labels_step,
+             additional_labels_dict_step) = final_eval_step(
+                 test_iterator, dataset_name)
+          except tf.errors.OutOfRangeError:
+            break
+
+          texts_all = texts_all.write(num_steps, text_step)
+          logits_all = logits_all.write(num_steps, logits_step)
+          labels_all = labels_all.write(num_steps, labels_step)
+          for name in identity_label_names[dataset_name]:
+            additional_labels_all_dict[name] = (
+                additional_labels_all_dict[name].write(
+                    num_steps, additional_labels_dict_step[name]))
+          num_steps += 1
+
+        texts_all = texts_all.concat()
+        logits_all = logits_all.concat()
+        labels_all = labels_all.concat()
+        additional_labels_all = []
+        if additional_labels_all_dict:
+          for identity_label_name in identity_label_names[dataset_name]:
+            additional_labels_all.append(
+                additional_labels_all_dict[identity_label_name].concat())
+        additional_labels_all = tf.convert_to_tensor(additional_labels_all)
+
+        predictions = {
+            'texts': texts_all,
+            'labels': labels_all,
+            'logits': logits_all,
+        }
         if 'identity' in dataset_name:
-          for identity_label_name in _IDENTITY_LABELS:
-            additional_labels_all_dict[identity_label_name].append(
-                additional_labels_dict_step[identity_label_name])
-
-      texts_all = tf.concat(texts_all, axis=0)
-      logits_all = tf.concat(logits_all, axis=0)
-      labels_all = tf.concat(labels_all, axis=0)
-      additional_labels_all = []
-      if additional_labels_all_dict:
-        for identity_label_name in _IDENTITY_LABELS:
-          additional_labels_all.append(
-              tf.concat(
-                  additional_labels_all_dict[identity_label_name], axis=0))
-      additional_labels_all = tf.convert_to_tensor(additional_labels_all)
-
-      save_prediction(
-          texts_all.numpy(),
-          path=os.path.join(FLAGS.output_dir, 'texts_{}'.format(dataset_name)))
-      save_prediction(
-          labels_all.numpy(),
-          path=os.path.join(FLAGS.output_dir, 'labels_{}'.format(dataset_name)))
-      save_prediction(
-          logits_all.numpy(),
-          path=os.path.join(FLAGS.output_dir, 'logits_{}'.format(dataset_name)))
-      if 'identity' in dataset_name:
-        save_prediction(
-            additional_labels_all.numpy(),
-            path=os.path.join(FLAGS.output_dir,
-                              'additional_labels_{}'.format(dataset_name)))
-      logging.info('Done with testing on %s', dataset_name)
+          predictions['additional_labels'] = additional_labels_all
+        for prediction_name, prediction in predictions.items():
+          save_futures.append(
+              save_executor.submit(
+                  save_prediction,
+                  prediction.numpy(),
+                  path=os.path.join(
+                      FLAGS.output_dir,
+                      '{}_{}'.format(prediction_name, dataset_name))))
+        logging.info('Done with testing on %s', dataset_name)
+
+      # Wait for all the predictions to be written, re-raising any error.
+      for save_future in save_futures:
+        save_future.result()
 
   else:
     train_iterator = iter(train_dataset)
     start_time = time.time()
     for epoch in range(initial_epoch, FLAGS.train_epochs):
       logging.info('Starting to run epoch: %s', epoch)
-      for step in range(steps_per_epoch):
-        train_step(train_iterator)
+      for step in range(0, steps_per_epoch, FLAGS.steps_per_loop):
+        num_steps = min(FLAGS.steps_per_loop, steps_per_epoch - step)
+        # Pass tf constant to avoid re-tracing.
+        train_step(train_iterator, tf.constant(num_steps))
 
-        current_step = epoch * steps_per_epoch + (step + 1)
+        current_step = epoch * steps_per_epoch + (step + num_steps)
         max_steps = steps_per_epoch * FLAGS.train_epochs
         time_elapsed = time.time() - start_time
         steps_per_sec = float(current_step) / time_elapsed
@@ -686,20 +1018,59 @@ def main(argv):
                    'ETA: {:.0f} min. Time elapsed: {:.0f} min'.format(
                        current_step / max_steps, epoch + 1, FLAGS.train_epochs,
                        steps_per_sec, eta_seconds / 60, time_elapsed / 60))
-        if step % 20 == 0:
-          logging.info(message)
+        logging.info(message)
 
       if epoch % FLAGS.evaluation_interval == 0:
+        host_results = {}
         for dataset_name, test_dataset in test_datasets.items():
           test_iterator = iter(test_dataset)
           logging.info('Testing on dataset %s', dataset_name)
-          for step in range(steps_per_eval[dataset_name]):
+          # The TensorArrays grow with the number of steps, which is unknown
+          # for bucketed datasets.
+          labels_all, ece_labels_all, ece_probs_all = [
+              tf.TensorArray(
+                  tf.float32, size=0, dynamic_size=True, infer_shape=False)
+              for _ in range(3)
+          ]
+          for step in get_eval_steps(steps_per_eval[dataset_name]):
             if step % 20 == 0:
               logging.info('Starting to run eval step %s of epoch: %s', step,
                            epoch)
-            test_step(test_iterator, dataset_name)
+            try:
+              labels_step, ece_labels_step, ece_probs_step = test_steps[
+                  dataset_name](test_iterator)
+            except tf.errors.OutOfRangeError:
+              break
+            labels_all = labels_all.write(step, labels_step)
+            ece_labels_all = ece_labels_all.write(step, ece_labels_step)
+            ece_probs_all = ece_probs_all.write(step, ece_probs_step)
           logging.info('Done with testing on %s', dataset_name)
 
+          # Compute the collaborative accuracy and the ranking metrics once
+          # over the whole dataset.
+          labels_all = labels_all.concat()
+          ece_labels_all = ece_labels_all.concat()
+          ece_probs_all = ece_probs_all.concat()
+          ranking_results = compute_ranking_metrics(
+              labels_all.numpy(), ece_probs_all[:, 1].numpy())
+          for metric_name, result in ranking_results.items():
+            if dataset_name == 'ind':
+              result_name = 'test/{}'.format(metric_name)
+            else:
+              result_name = 'test/{}_{}'.format(metric_name, dataset_name)
+            host_results[result_name] = result
+
+          for fraction in FLAGS.fractions:
+            collab_acc = um.OracleCollaborativeAccuracy(
+                fraction=float(fraction), num_bins=FLAGS.num_bins)
+            collab_acc.update_state(ece_labels_all, ece_probs_all)
+            if dataset_name == 'ind':
+              result_name = 'test_collab_acc/collab_acc_{}'.format(fraction)
+            else:
+              result_name = 'test_collab_acc/collab_acc_{}_{}'.format(
+                  fraction, dataset_name)
+            host_results[result_name] = collab_acc.result()
+
         logging.info('Train Loss: %.4f, ECE: %.2f, Accuracy: %.2f',
                      metrics['train/loss'].result(),
                      metrics['train/ece'].result(),
@@ -708,6 +1079,7 @@ def main(argv):
         total_results = {
             name: metric.result() for name, metric in metrics.items()
         }
+        total_results.update(host_results)
         with summary_writer.as_default():
           for name, result in total_results.items():
             tf.summary.scalar(name, result, step=epoch + 1)
@@ -717,11 +1089,11 @@ def main(argv):
 
       if (FLAGS.checkpoint_interval > 0 and
           (epoch + 1) % FLAGS.checkpoint_interval == 0):
-        checkpoint_name = checkpoint.save(
-            os.path.join(FLAGS.output_dir, 'checkpoint'))
+        checkpoint_name = checkpoint_manager.save()
         logging.info('Saved checkpoint to %s', checkpoint_name)
 
-    # Save model in SavedModel format on exit.
+    # Save model in SavedModel format on exit. Prediction mode loads it
+    # directly when `eval_checkpoint_dir` points to this directory.
     final_save_name = os.path.join(FLAGS.output_dir, 'model')
     model.save(final_save_name)
     logging.info('Saved model to %s', final_save_name)
@@ -0,0 +1,91 @@
+# coding=utf-8
+# Copyright 2020 The Uncertainty Baselines Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Tests for sngp."""
+from absl.testing import parameterized
+
+import numpy as np
+import tensorflow as tf
+import sngp  # local file import
+
+
+def _compute_pairwise_auroc(labels, probs):
+  """Computes the weighted AUROC by comparing all pairs of examples."""
+  pos_weights = labels[:, None]
+  neg_weights = 1. - labels[None, :]
+  pair_scores = ((probs[:, None] > probs[None, :]) +
+                 0.5 * (probs[:, None] == probs[None, :]))
+  return (np.sum(pos_weights * neg_weights * pair_scores) /
+          (np.sum(labels) * np.sum(1. - labels)))
+
+
+def _compute_pairwise_aupr(labels, probs):
+  """Computes the weighted average precision at the probability of examples."""
+  is_retrieved = probs[None, :] >= probs[:, None]
+  precisions = (np.sum(is_retrieved * labels[None, :], axis=1) /
+                np.sum(is_retrieved, axis=1))
+  return np.sum(labels * precisions) / np.sum(labels)
+
+
+class ComputeRankingMetricsTest(tf.test.TestCase, parameterized.TestCase):
+
+  @parameterized.named_parameters(
+      ('binary_labels', np.array([1., 0., 1., 0., 0., 1.]),
+       np.array([.9, .1, .4, .6, .2, .8])),
+      ('tied_probs', np.array([1., 0., 1., 0., 0., 1.]),
+       np.array([.7, .7, .3, .3, .3, .9])),
+      ('fractional_labels', np.array([.2, .9, .5, 0., 1., .6, .5]),
+       np.array([.1, .8, .5, .5, .9, .3, .5])))
+  def test_ranking_metrics(self, labels, probs):
+    """Tests the ranking metrics against their pairwise definitions."""
+    results = sngp.compute_ranking_metrics(labels, probs)
+
+    self.assertAllClose(results['auroc'],
+                        _compute_pairwise_auroc(labels, probs))
+    self.assertAllClose(results['aupr'], _compute_pairwise_aupr(labels, probs))
+    self.assertAllClose(results['brier'], np.mean(np.square(labels - probs)))
+
+  def test_ranking_metrics_random(self):
+    """Tests the ranking metrics on random fractional labels with ties."""
+    random_state = np.random.RandomState(0)
+    labels = random_state.randint(0, 5, size=100) / 4.
+    probs = random_state.randint(0, 20, size=100) / 20.
+    results = sngp.compute_ranking_metrics(labels, probs)
+
+    self.assertAllClose(results['auroc'],
+                        _compute_pairwise_auroc(labels, probs))
+    self.assertAllClose(results['aupr'], _compute_pairwise_aupr(labels, probs))
+
+  def test_ranking_metrics_without_negatives(self):
+    """Tests that the AUROC is skipped without negative weight."""
+    results = sngp.compute_ranking_metrics(
+        np.array([1., 1., 1.]), np.array([.2, .5, .5]))
+
+    self.assertNotIn('auroc', results)
+    self.assertAllClose(results['aupr'], 1.)
+
+  def test_ranking_metrics_without_positives(self):
+    """Tests that the AUROC and AUPR are skipped without positive weight."""
+    results = sngp.compute_ranking_metrics(
+        np.array([0., 0., 0.]), np.array([.2, .5, .5]))
+
+    self.assertNotIn('auroc', results)
+    self.assertNotIn('aupr', results)
+    self.assertAllClose(results['brier'], (.04 + .25 + .25) / 3)
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -38,6 +38,9 @@ _IDENTITY_LABELS = ('male', 'female', 'transgender', 'other_gender',
                     'intellectual_or_learning_disability',
                     'psychiatric_or_mental_illness', 'other_disability')
 
+# Names of the BERT token features in the local TFRecords.
+BERT_FEATURE_NAMES = ('input_ids', 'input_mask', 'segment_ids')
+
 _DATA_SPLIT_NAMES = (base.Split.TRAIN.value, base.Split.TEST.value,
                      base.Split.VAL.value)
 
@@ -191,7 +194,14 @@ class _JigsawToxicityDataset(base.BaseDataset):
     def _example_parser(example: Dict[str, tf.Tensor]) -> Dict[str, Any]:
       """Preprocesses sentences as well as toxicity and other labels."""
       if self._data_dir:
-        return tf.io.parse_example(example, self.feature_spec)
+        parsed_example = tf.io.parse_example(example, self.feature_spec)
+        # TF Examples only store int64 features, while the BERT encoder takes
+        # int32 inputs. Cast the token features once here, which halves their
+        # size in the input pipeline and in the host to device transfers.
+        for feature_name in BERT_FEATURE_NAMES:
+          parsed_example[feature_name] = tf.cast(
+              parsed_example[feature_name], tf.int32)
+        return parsed_example
       else:
         label = example['toxicity']
         feature = example['text']
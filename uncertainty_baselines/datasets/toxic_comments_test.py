@@ -16,6 +16,8 @@
 # Lint as: python3
 """Tests for toxicity classification datasets."""
 
+import os
+
 from absl.testing import parameterized
 
 import tensorflow as tf
@@ -29,6 +31,26 @@ CCIdentitiesDataClass = toxic_comments.CivilCommentsIdentitiesDataset
 WTDataClass = toxic_comments.WikipediaToxicityDataset
 
 
+def _write_local_tf_records(path, feature_spec, num_examples):
+  """Writes TF Examples with constant features following `feature_spec`."""
+  feature = {}
+  for name, spec in feature_spec.items():
+    num_values = spec.shape[0] if spec.shape else 1
+    if spec.dtype == tf.int64:
+      feature[name] = tf.train.Feature(
+          int64_list=tf.train.Int64List(value=[1] * num_values))
+    elif spec.dtype == tf.float32:
+      feature[name] = tf.train.Feature(
+          float_list=tf.train.FloatList(value=[0.5] * num_values))
+    else:
+      feature[name] = tf.train.Feature(
+          bytes_list=tf.train.BytesList(value=[b'text'] * num_values))
+  example = tf.train.Example(features=tf.train.Features(feature=feature))
+  with tf.io.TFRecordWriter(path) as writer:
+    for _ in range(num_examples):
+      writer.write(example.SerializeToString())
+
+
 class ToxicCommentsDatasetTest(tf.test.TestCase, parameterized.TestCase):
 
   @parameterized.named_parameters(
@@ -80,6 +102,33 @@ class ToxicCommentsDatasetTest(tf.test.TestCase, parameterized.TestCase):
       self.assertEqual(element[subtype_name].shape[0], batch_size)
       self.assertEqual(element[subtype_name].dtype, tf.float32)
 
+  @parameterized.named_parameters(
+      ('civil_comments', CCDataClass),
+      ('civil_comments_identities', CCIdentitiesDataClass),
+      ('wikipedia_toxicity', WTDataClass))
+  def testBertFeatureDtype(self, dataset_class):
+    """Test if the BERT token features of local TFRecords are int32."""
+    eval_batch_size = 5
+    max_seq_length = 8
+    data_dir = self.create_tempdir().full_path
+    dataset_builder = dataset_class(
+        batch_size=9,
+        eval_batch_size=eval_batch_size,
+        shuffle_buffer_size=20,
+        max_seq_length=max_seq_length,
+        data_dir=data_dir)
+    _write_local_tf_records(
+        os.path.join(data_dir, 'test_0.tfrecord'),
+        dataset_builder.feature_spec,
+        num_examples=eval_batch_size)
+    dataset = dataset_builder.build(base.Split.TEST).take(1)
+    element = next(iter(dataset))
+
+    for feature_name in ('input_ids', 'input_mask', 'segment_ids'):
+      self.assertEqual(element[feature_name].shape,
+                       (eval_batch_size, max_seq_length))
+      self.assertEqual(element[feature_name].dtype, tf.int32)
+
 
 if __name__ == '__main__':
   tf.test.main()
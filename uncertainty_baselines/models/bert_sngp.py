@@ -32,6 +32,7 @@ with a Gaussian process layer.
      https://papers.nips.cc/paper/7181-attention-is-all-you-need
 """
 import functools
+import math
 
 from typing import Any, Dict, Mapping, Optional
 
@@ -45,6 +46,10 @@ from official.nlp.modeling import networks as bert_encoder
 
 _EinsumDense = tf.keras.layers.experimental.EinsumDense
 
+# Additive attention logit of the masked keys, which matches the masking of the
+# tf.keras.layers.Softmax layer in float32.
+_MASKED_LOGIT = -1e9
+
 # A dict of regex patterns and their replacements. Use to update weight names
 # in a classic pre-trained checkpoint to those in
 # SpectralNormalizedTransformerEncoder.
@@ -54,6 +59,13 @@ CHECKPOINT_REPL_PATTERNS = {
 }
 
 
+def _stateless_dropout(inputs: tf.Tensor, rate: float,
+                       seed: tf.Tensor) -> tf.Tensor:
+  """Applies dropout with a random mask that is reproducible given `seed`."""
+  keep_mask = tf.random.stateless_uniform(tf.shape(inputs), seed=seed) >= rate
+  return tf.where(keep_mask, inputs / (1. - rate), tf.zeros_like(inputs))
+
+
 def make_spec_norm_dense_layer(**spec_norm_kwargs: Mapping[str, Any]):
   """Defines a spectral-normalized EinsumDense layer.
 
@@ -209,15 +221,25 @@ class SpectralNormalizedMultiHeadAttention(tf.keras.layers.MultiHeadAttention):
   This is an implementation of multi-headed attention layer [2] with the option
   to replace the original EinsumDense layer with its spectral-normalized
   counterparts.
+
+  If `attention_chunk_size` is set, the attention over sequences longer than
+  `attention_chunk_size` keys is computed chunk by chunk with a streaming
+  softmax, which keeps a running maximum and sum of the exponentiated attention
+  logits. Each chunk is recomputed in the backward pass, so that the attention
+  logits of only a single chunk are kept in memory, i.e., O(seq_length *
+  attention_chunk_size) rather than O(seq_length^2) per head, at the cost of
+  a second forward computation of the attention.
   """
 
   def __init__(self,
                use_spec_norm: bool = False,
                spec_norm_kwargs: Optional[Dict[str, Any]] = None,
+               attention_chunk_size: Optional[int] = None,
                **kwargs: Dict[str, Any]):
     super().__init__(**kwargs)
     self._use_spec_norm = use_spec_norm
     self._spec_norm_kwargs = spec_norm_kwargs
+    self._attention_chunk_size = attention_chunk_size
     self._spec_norm_dense_layer = make_spec_norm_dense_layer(**spec_norm_kwargs)
 
   def _update_einsum_dense(
@@ -251,10 +273,141 @@ class SpectralNormalizedMultiHeadAttention(tf.keras.layers.MultiHeadAttention):
     # value layers in the self-attention module.
     self._output_dense = self._update_einsum_dense(self._output_dense)
 
+  def _get_dropout_seed(self) -> tf.Tensor:
+    """Returns the seed of the stateless attention dropout of a single call."""
+    return tf.random.uniform([2], maxval=tf.int32.max, dtype=tf.int32)
+
+  def _compute_chunk_attention(self,
+                               query: tf.Tensor,
+                               key_chunk: tf.Tensor,
+                               value_chunk: tf.Tensor,
+                               max_logits: tf.Tensor,
+                               sum_exp: tf.Tensor,
+                               output: tf.Tensor,
+                               mask_chunk: tf.Tensor,
+                               dropout_seed: Optional[tf.Tensor] = None):
+    """Accumulates the streaming softmax attention over a chunk of keys.
+
+    Args:
+      query: Scaled query tensor of shape [B, T, N, key_dim].
+      key_chunk: Key tensor of shape [B, C, N, key_dim].
+      value_chunk: Value tensor of shape [B, C, N, value_dim].
+      max_logits: Running maximum of the attention logits of shape [B, T, N].
+      sum_exp: Running sum of the exponentiated logits of shape [B, T, N].
+      output: Running unnormalized attention output of shape
+        [B, T, N, value_dim].
+      mask_chunk: Float mask of shape [B, T, C].
+      dropout_seed: Seed of the stateless dropout of the chunk, which makes
+        its recomputation in the backward pass use the same dropout mask. If
+        None, no dropout is applied.
+
+    Returns:
+      The updated max_logits, sum_exp and output.
+    """
+    # The softmax statistics are accumulated in float32 for numerical
+    # stability under mixed precision.
+    logits = tf.cast(
+        tf.einsum('abnh,asnh->abns', query, key_chunk), tf.float32)
+    logits += (1. - mask_chunk[:, :, tf.newaxis, :]) * _MASKED_LOGIT
+
+    # Rescales the statistics of the previous chunks to the new maximum.
+    new_max_logits = tf.maximum(max_logits, tf.reduce_max(logits, axis=-1))
+    correction = tf.exp(max_logits - new_max_logits)
+    weights = tf.exp(logits - new_max_logits[..., tf.newaxis])
+    sum_exp = sum_exp * correction + tf.reduce_sum(weights, axis=-1)
+
+    # Dropout commutes with the normalization by the sum of the weights,
+    # which is applied after the last chunk.
+    if dropout_seed is not None:
+      weights = _stateless_dropout(weights, self._dropout, dropout_seed)
+    chunk_output = tf.einsum('abns,asnh->abnh',
+                             tf.cast(weights, value_chunk.dtype), value_chunk)
+    output = (output * correction[..., tf.newaxis] +
+              tf.cast(chunk_output, tf.float32))
+    return new_max_logits, sum_exp, output
+
+  def _compute_attention(self,
+                         query: tf.Tensor,
+                         key: tf.Tensor,
+                         value: tf.Tensor,
+                         attention_mask: Optional[tf.Tensor] = None,
+                         training: Optional[bool] = None):
+    """Applies the dot-product attention, optionally over chunks of keys.
+
+    The chunked attention is used for attention over the sequence axis of
+    [batch_size, seq_length, num_heads, dim] projections whose static number
+    of keys is larger than the chunk size. It does not materialize the
+    attention scores, which are returned as None. Otherwise, the default
+    attention is computed.
+
+    Args:
+      query: Projected query tensor of shape [B, T, N, key_dim].
+      key: Projected key tensor of shape [B, S, N, key_dim].
+      value: Projected value tensor of shape [B, S, N, value_dim].
+      attention_mask: A boolean mask of shape [B, T, S] that prevents attention
+        to certain positions.
+      training: Whether the layer should behave in training mode.
+
+    Returns:
+      attention_output: Attention output of shape [B, T, N, value_dim].
+      attention_scores: Attention probabilities of shape [B, N, T, S], or None
+        for the chunked attention.
+    """
+    chunk_size = self._attention_chunk_size
+    key_length = key.shape[1]
+    # The chunked attention needs to know whether to apply dropout at trace
+    # time.
+    static_training = tf.get_static_value(
+        tf.keras.backend.learning_phase() if training is None else training)
+    if (not chunk_size or key_length is None or key_length <= chunk_size or
+        static_training is None or tuple(self._attention_axes) != (1,)):
+      return super()._compute_attention(
+          query, key, value, attention_mask=attention_mask, training=training)
+
+    query_shape = tf.shape(query)
+    if attention_mask is None:
+      attention_mask = tf.ones([query_shape[0], query_shape[1], key_length])
+    attention_mask = tf.cast(attention_mask, tf.float32)
+    query = tf.multiply(query, 1.0 / math.sqrt(float(self._key_dim)))
+
+    dropout_seed = None
+    if static_training and self._dropout > 0.:
+      dropout_seed = self._get_dropout_seed()
+
+    def make_compute_chunk_fn(mask_chunk, chunk_dropout_seed):
+      """Returns the recomputed attention of a chunk given its mask and seed."""
+
+      @tf.recompute_grad
+      def compute_chunk(*args):
+        return self._compute_chunk_attention(
+            *args, mask_chunk=mask_chunk, dropout_seed=chunk_dropout_seed)
+
+      return compute_chunk
+
+    # Softmax statistics are of shape [B, T, N]. The chunks are unrolled, since
+    # the number of keys is static.
+    max_logits = tf.fill(query_shape[:3], float('-inf'))
+    sum_exp = tf.zeros(query_shape[:3])
+    output = tf.zeros(
+        tf.concat([query_shape[:3], tf.shape(value)[-1:]], axis=0))
+    for chunk_index, start in enumerate(range(0, key_length, chunk_size)):
+      end = min(start + chunk_size, key_length)
+      chunk_dropout_seed = None
+      if dropout_seed is not None:
+        chunk_dropout_seed = dropout_seed + tf.constant([0, chunk_index])
+      compute_chunk = make_compute_chunk_fn(attention_mask[:, :, start:end],
+                                            chunk_dropout_seed)
+      max_logits, sum_exp, output = compute_chunk(
+          query, key[:, start:end], value[:, start:end], max_logits, sum_exp,
+          output)
+    attention_output = output / sum_exp[..., tf.newaxis]
+    return tf.cast(attention_output, value.dtype), None
+
   def get_config(self):
     config = super().get_config()
     config['use_spec_norm'] = self._use_spec_norm
     config['spec_norm_kwargs'] = self._spec_norm_kwargs
+    config['attention_chunk_size'] = self._attention_chunk_size
     return config
 
 
@@ -267,6 +420,7 @@ class SpectralNormalizedTransformer(bert_layers.TransformerScaffold):
                use_spec_norm_att: bool = False,
                use_spec_norm_ffn: bool = False,
                spec_norm_kwargs: Optional[Mapping[str, Any]] = None,
+               attention_chunk_size: Optional[int] = None,
                **kwargs):
     """Initializer.
 
@@ -280,6 +434,9 @@ class SpectralNormalizedTransformer(bert_layers.TransformerScaffold):
       use_spec_norm_ffn: Whether to use spectral normalization in the
         feedforward layer.
       spec_norm_kwargs: Keyword arguments to the spectral normalization layer.
+      attention_chunk_size: Number of keys per chunk of the streaming softmax
+        attention. If None, the attention is computed over all keys at once.
+        It is also computed at once for sequences of at most this many keys.
       **kwargs: Additional keyword arguments to TransformerScaffold.
     """
     self._use_layer_norm_att = use_layer_norm_att
@@ -287,6 +444,7 @@ class SpectralNormalizedTransformer(bert_layers.TransformerScaffold):
     self._use_spec_norm_att = use_spec_norm_att
     self._use_spec_norm_ffn = use_spec_norm_ffn
     self._spec_norm_kwargs = spec_norm_kwargs
+    self._attention_chunk_size = attention_chunk_size
 
     feedforward_cls = functools.partial(
         SpectralNormalizedFeedforwardLayer,
@@ -297,7 +455,8 @@ class SpectralNormalizedTransformer(bert_layers.TransformerScaffold):
     attention_cls = functools.partial(
         SpectralNormalizedMultiHeadAttention,
         use_spec_norm=self._use_spec_norm_att,
-        spec_norm_kwargs=self._spec_norm_kwargs)
+        spec_norm_kwargs=self._spec_norm_kwargs,
+        attention_chunk_size=self._attention_chunk_size)
 
     super().__init__(
         feedforward_cls=feedforward_cls, attention_cls=attention_cls, **kwargs)
@@ -441,7 +600,9 @@ def get_spectral_normalized_transformer_encoder(
     use_layer_norm_ffn: bool = True,
     use_spec_norm_att: bool = False,
     use_spec_norm_ffn: bool = False,
-    use_spec_norm_plr: bool = False) -> SpectralNormalizedTransformerEncoder:
+    use_spec_norm_plr: bool = False,
+    attention_chunk_size: Optional[int] = None
+) -> SpectralNormalizedTransformerEncoder:
   """Creates a SpectralNormalizedTransformerEncoder from a bert_config.
 
   Args:
@@ -457,6 +618,9 @@ def get_spectral_normalized_transformer_encoder(
       feedforward layer.
     use_spec_norm_plr: (bool) Whether to apply spectral normalization to the
       final pooler layer for CLS token.
+    attention_chunk_size: (int) Number of keys per chunk of the streaming
+      softmax attention. If None, the attention is computed over all keys at
+      once.
 
   Returns:
     A SpectralNormalizedTransformerEncoder object.
@@ -479,6 +643,7 @@ def get_spectral_normalized_transformer_encoder(
       kernel_initializer=tf.keras.initializers.TruncatedNormal(
           stddev=bert_config.initializer_range),
       spec_norm_kwargs=spec_norm_kwargs,
+      attention_chunk_size=attention_chunk_size,
   )
   kwargs = dict(
       embedding_cfg=embedding_cfg,
@@ -571,7 +736,8 @@ def create_model(num_classes,
                  use_spec_norm_ffn=True,
                  use_layer_norm_att=False,
                  use_layer_norm_ffn=False,
-                 use_spec_norm_plr=False):
+                 use_spec_norm_plr=False,
+                 attention_chunk_size=None):
   """Creates a BERT classifier model with MC dropout."""
   last_layer_initializer = tf.keras.initializers.TruncatedNormal(
       stddev=bert_config.initializer_range)
@@ -584,7 +750,8 @@ def create_model(num_classes,
       use_layer_norm_ffn=use_layer_norm_ffn,
       use_spec_norm_att=use_spec_norm_att,
       use_spec_norm_ffn=use_spec_norm_ffn,
-      use_spec_norm_plr=use_spec_norm_plr)
+      use_spec_norm_plr=use_spec_norm_plr,
+      attention_chunk_size=attention_chunk_size)
 
   # Build classification model.
   sngp_bert_model = BertGaussianProcessClassifier(
@@ -15,6 +15,8 @@
 
 # Lint as: python3
 """Tests for bert_sngp."""
+import functools
+
 from absl.testing import parameterized
 
 import numpy as np
@@ -143,6 +145,105 @@ class SngpModelTest(tf.test.TestCase, parameterized.TestCase):
     self.assertAllClose(spec_norm_list_observed, spec_norm_list_expected,
                         atol=1e-3)
 
+  @parameterized.named_parameters(('no_mask', False), ('with_mask', True))
+  def test_chunked_attention(self, use_attention_mask):
+    """Tests if the chunked attention matches the full attention."""
+    tf.random.set_seed(self.random_seed)
+    input_tensor = tf.random.normal(self.input_shape_3d)
+
+    attention_mask = None
+    if use_attention_mask:
+      # Keep the first key of every query unmasked, so that every query attends
+      # to at least one key.
+      mask_shape = (self.batch_size, self.seq_length, self.seq_length - 1)
+      attention_mask = tf.concat(
+          [tf.ones(mask_shape[:2] + (1,), dtype=tf.int32),
+           tf.cast(tf.random.uniform(mask_shape) > 0.5, tf.int32)],
+          axis=-1)
+
+    full_attention = SNAttention(
+        spec_norm_kwargs=self.spec_norm_kwargs, **self.attention_kwargs)
+    # The chunk size does not divide the sequence length, which tests the
+    # shorter last chunk.
+    chunked_attention = SNAttention(
+        spec_norm_kwargs=self.spec_norm_kwargs,
+        attention_chunk_size=3,
+        **self.attention_kwargs)
+
+    full_output = full_attention(
+        input_tensor, input_tensor, attention_mask=attention_mask)
+    _ = chunked_attention(
+        input_tensor, input_tensor, attention_mask=attention_mask)
+    chunked_attention.set_weights(full_attention.get_weights())
+    chunked_output = chunked_attention(
+        input_tensor, input_tensor, attention_mask=attention_mask)
+
+    self.assertAllClose(chunked_output, full_output, atol=1e-5)
+
+  def test_chunked_attention_gradients(self):
+    """Tests the chunked attention and its gradients with dropout under XLA."""
+    chunk_size = 3
+    dropout_rate = 0.5
+    dropout_seed = tf.constant([1, 2])
+
+    class FixedSeedAttention(SNAttention):
+
+      def _get_dropout_seed(self):
+        return dropout_seed
+
+    tf.random.set_seed(self.random_seed)
+    input_tensor = tf.random.normal(self.input_shape_3d)
+    attention_layer = FixedSeedAttention(
+        spec_norm_kwargs=self.spec_norm_kwargs,
+        attention_chunk_size=chunk_size,
+        dropout=dropout_rate,
+        **self.attention_kwargs)
+    # Build the layer.
+    _ = attention_layer(input_tensor, input_tensor)
+
+    query, key, value, output_weights = [
+        tf.random.normal(self.input_shape_4d) for _ in range(4)
+    ]
+    attention_mask = tf.cast(
+        tf.random.uniform(
+            (self.batch_size, self.seq_length, self.seq_length)) > 0.5,
+        tf.float32)
+
+    def chunked_attention(query, key, value):
+      output, _ = attention_layer._compute_attention(  # pylint: disable=protected-access
+          query, key, value, attention_mask=attention_mask, training=True)
+      return output
+
+    def reference_attention(query, key, value):
+      """Computes the full attention with the dropout masks of the chunks."""
+      logits = tf.einsum('abnh,asnh->abns', query / np.sqrt(self.key_dim), key)
+      logits += (1. - attention_mask[:, :, tf.newaxis, :]) * -1e9
+      probs = tf.nn.softmax(logits, axis=-1)
+      chunk_probs = tf.split(
+          probs, [chunk_size, self.seq_length - chunk_size], axis=-1)
+      probs = tf.concat([
+          bert_sngp._stateless_dropout(  # pylint: disable=protected-access
+              chunk, dropout_rate, dropout_seed + tf.constant([0, index]))
+          for index, chunk in enumerate(chunk_probs)
+      ], axis=-1)
+      return tf.einsum('abns,asnh->abnh', probs, value)
+
+    def compute_gradients(attention_fn, query, key, value):
+      with tf.GradientTape() as tape:
+        tape.watch([query, key, value])
+        output = attention_fn(query, key, value)
+        loss = tf.reduce_sum(output * output_weights)
+      return output, tape.gradient(loss, [query, key, value])
+
+    chunked_output, chunked_grads = tf.function(
+        functools.partial(compute_gradients, chunked_attention),
+        jit_compile=True)(query, key, value)
+    reference_output, reference_grads = compute_gradients(
+        reference_attention, query, key, value)
+
+    self.assertAllClose(chunked_output, reference_output, atol=1e-5)
+    self.assertAllClose(chunked_grads, reference_grads, atol=1e-5)
+
   @parameterized.named_parameters(('att_and_ffn', True, True),
                                   ('att_only', False, True),
                                   ('ffn_only', True, False))